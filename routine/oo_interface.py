@@ -11,7 +11,7 @@ from ipywidgets import Layout, widgets
 from .plotting import plot_events, plot_peaks, plot_signals
 from .processing import find_pks, photobleach_correction
 from .ts_alignment import align_ts, label_bout
-from .utilities import load_data, pool_events
+from .utilities import load_data, pool_events, read_data, read_ts, write_data
 
 
 class NPMBase:
@@ -21,6 +21,7 @@ class NPMBase:
             "layout": Layout(width="80%"),
         }
         self.data = None
+        self.param_roi_dict = None
         self.fig_path = fig_path
         self.out_path = out_path
         os.makedirs(self.fig_path, exist_ok=True)
@@ -44,14 +45,32 @@ class NPMBase:
                 w_data.observe(self.on_set_data_remote, names="value")
                 display(w_data)
         else:
-            self.data = pd.read_csv(dpath)
+            self.data = read_data(dpath)
 
     def on_set_data_remote(self, change) -> None:
         dat = change["new"][0]["content"].tobytes()
-        self.data = pd.read_csv(io.BytesIO(dat), encoding="utf8")
+        self.data = read_data(io.BytesIO(dat), encoding="utf8")
 
     def on_set_data_local(self, fc) -> None:
-        self.data = pd.read_csv(fc.selected)
+        self.data = read_data(fc.selected)
+
+    def set_roi(self, roi_dict: dict = None) -> None:
+        assert self.data is not None, "Please set data first!"
+        if roi_dict is None:
+            w_txt = widgets.Label("ROIs to analyze (CTRL/CMD click to Select Multiple)")
+            w_roi = widgets.SelectMultiple(
+                options=tuple(self.data.columns),
+                tooltip="Region1G Region2R etc",
+                **self.wgt_opts,
+            )
+            w_roi.observe(self.on_roi, names="value")
+            display(widgets.VBox([w_txt, w_roi]))
+        else:
+            self.param_roi_dict = roi_dict
+
+    def on_roi(self, change) -> None:
+        rois = change["new"]
+        self.param_roi_dict = {r: r for r in rois}
 
     def set_paths(self, fig_path=None, out_path=None) -> None:
         if fig_path is None:
@@ -86,8 +105,8 @@ class NPMProcess(NPMBase):
         self.param_nfm_discard = None
         self.param_pk_prominence = None
         self.param_led_dict = {7: "initial", 1: "415nm", 2: "470nm", 4: "560nm"}
-        self.param_roi_dict = None
         self.param_base_sig = None
+        self.sig_idx = None
         self.data_norm = None
         print("Process initialized")
 
@@ -133,24 +152,6 @@ class NPMProcess(NPMBase):
     def on_pk_prominence(self, change) -> None:
         self.param_pk_prominence = change["new"]
 
-    def set_roi(self, roi_dict: dict = None) -> None:
-        assert self.data is not None, "Please set data first!"
-        if roi_dict is None:
-            w_txt = widgets.Label("ROIs to analyze (CTRL/CMD click to Select Multiple)")
-            w_roi = widgets.SelectMultiple(
-                options=self.data.columns,
-                tooltip="Region1G Region2R etc",
-                **self.wgt_opts,
-            )
-            w_roi.observe(self.on_roi, names="value")
-            display(widgets.VBox([w_txt, w_roi]))
-        else:
-            self.param_roi_dict = roi_dict
-
-    def on_roi(self, change) -> None:
-        rois = change["new"]
-        self.param_roi_dict = {r: r for r in rois}
-
     def set_roi_names(self, roi_dict: dict = None) -> None:
         assert self.param_roi_dict is not None, "Please set roi first!"
         if roi_dict is None:
@@ -208,6 +209,7 @@ class NPMProcess(NPMBase):
         self.data = load_data(
             self.data, self.param_nfm_discard, self.param_led_dict, self.param_roi_dict
         )
+        self.sig_idx = self.data.groupby("signal", sort=False, observed=True).indices
         fig = plot_signals(
             self.data, list(self.param_roi_dict.values()), default_window=(0, 10)
         )
@@ -221,7 +223,10 @@ class NPMProcess(NPMBase):
         assert self.param_roi_dict is not None, "Please set ROIs first!"
         assert self.param_base_sig is not None, "Please set baseline signal first!"
         self.data_norm = photobleach_correction(
-            self.data, self.param_base_sig, rois=list(self.param_roi_dict.values())
+            self.data,
+            self.param_base_sig,
+            rois=list(self.param_roi_dict.values()),
+            sig_idx=self.sig_idx,
         )
         fig = plot_signals(
             self.data_norm,
@@ -249,14 +254,16 @@ class NPMProcess(NPMBase):
         fig.update_layout(height=350 * nroi)
         display(fig)
 
-    def export_data(self, sigs=["415nm", "470nm-norm", "470nm-norm-zs"]) -> None:
+    def export_data(
+        self, sigs=["415nm", "470nm-norm", "470nm-norm-zs"], fmt="csv"
+    ) -> None:
         assert self.data_norm is not None, "Please process data first!"
         d = self.data_norm
         ds_path = os.path.join(self.out_path, "signals")
         os.makedirs(ds_path, exist_ok=True)
         for sig in sigs:
-            fpath = os.path.join(ds_path, "{}.csv".format(sig))
-            d[d["signal"] == sig].drop(columns=["signal"]).to_csv(fpath, index=False)
+            fpath = os.path.join(ds_path, "{}.{}".format(sig, fmt))
+            write_data(d[d["signal"] == sig].drop(columns=["signal"]), fpath)
             print("data saved to {}".format(fpath))
 
 
@@ -308,23 +315,19 @@ class NPMAlign(NPMBase):
 
     def load_ts(self, ts_path: str) -> pd.DataFrame:
         ts_name = os.path.split(ts_path)[1]
-        if ts_name.endswith(".csv"):
-            return ts_name, pd.read_csv(ts_path, header=None)
-        elif ts_path.endswith(".xlsx"):
-            return ts_name, pd.read_excel(ts_path, header=None)
-        else:
-            raise NotImplementedError("Unable to read {}".format(ts_path))
+        st = os.stat(ts_path)
+        return ts_name, read_ts(ts_path, st.st_mtime_ns, st.st_size).copy()
 
     def align_data(self) -> None:
         # self.data = label_bout(self.data, "Stimulation") # depracated
         self.data_align, self.ts = align_ts(self.data, self.ts_dict)
 
-    def export_data(self) -> None:
+    def export_data(self, fmt="csv") -> None:
         assert self.data_align is not None, "Please align ts first!"
         ds_path = os.path.join(self.out_path, "aligned")
         os.makedirs(ds_path, exist_ok=True)
-        fpath = os.path.join(ds_path, "master.csv")
-        self.data_align.to_csv(fpath, index=False)
+        fpath = os.path.join(ds_path, "master.{}".format(fmt))
+        write_data(self.data_align, fpath)
         print("data saved to {}".format(fpath))
 
 
@@ -356,24 +359,6 @@ class NPMPooling(NPMBase):
     def on_evt_range(self, change) -> None:
         self.param_evt_range = change["new"]
 
-    def set_roi(self, roi_dict: dict = None) -> None:
-        assert self.data is not None, "Please set data first!"
-        if roi_dict is None:
-            w_txt = widgets.Label("ROIs to analyze (CTRL/CMD click to Select Multiple)")
-            w_roi = widgets.SelectMultiple(
-                options=self.data.columns,
-                tooltip="Region1G Region2R etc",
-                **self.wgt_opts,
-            )
-            w_roi.observe(self.on_roi, names="value")
-            display(widgets.VBox([w_txt, w_roi]))
-        else:
-            self.param_roi_dict = roi_dict
-
-    def on_roi(self, change) -> None:
-        rois = change["new"]
-        self.param_roi_dict = {r: r for r in rois}
-
     def pool_events(self) -> None:
         self.evtdf = pool_events(
             self.data, self.param_evt_range, list(self.param_roi_dict.values())
@@ -382,10 +367,10 @@ class NPMPooling(NPMBase):
         fig.write_html(os.path.join(self.fig_path, "events.html"))
         display(fig)
 
-    def export_data(self) -> None:
+    def export_data(self, fmt="csv") -> None:
         assert self.evtdf is not None, "Please pool events first!"
         ds_path = os.path.join(self.out_path, "events")
         os.makedirs(ds_path, exist_ok=True)
-        dpath = os.path.join(ds_path, "master.csv")
-        self.evtdf.to_csv(dpath, index=False)
+        dpath = os.path.join(ds_path, "master.{}".format(fmt))
+        write_data(self.evtdf, dpath)
         print("data saved to {}".format(dpath))
@@ -4,19 +4,47 @@ import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
-from .utilities import enumerated_product
+from .utilities import enumerated_product, lttb
 
 
-def plot_signals(data, rois, fps=30, default_window=None, group_dict=None):
-    dat_long = data[["SystemTimestamp", "signal"] + rois].melt(
-        id_vars=["SystemTimestamp", "signal"], var_name="roi", value_name="raw"
-    )
-    t0 = dat_long["SystemTimestamp"].min()
-    dat_long["Time (s)"] = dat_long["SystemTimestamp"] - t0
+def plot_signals(
+    data, rois, fps=30, default_window=None, group_dict=None, max_pts=3000
+):
+    ts = data["SystemTimestamp"].to_numpy()
+    sig = data["signal"].to_numpy()
     if group_dict is not None:
-        dat_long["signal_group"] = dat_long["signal"].map(group_dict)
+        sig_grp = data["signal"].map(group_dict).to_numpy()
     else:
-        dat_long["signal_group"] = dat_long["signal"]
+        sig_grp = sig
+    dat = data[rois].to_numpy()
+    nfm, nroi = dat.shape
+    # categories follow order of appearance so facets and colors are unchanged
+    sig_codes, sig_cats = pd.factorize(sig)
+    grp_codes, grp_cats = pd.factorize(sig_grp)
+    dat_long = pd.DataFrame(
+        {
+            "Time (s)": np.tile(ts - np.nanmin(ts), nroi),
+            "signal": pd.Categorical.from_codes(
+                np.tile(sig_codes, nroi), categories=sig_cats
+            ),
+            "signal_group": pd.Categorical.from_codes(
+                np.tile(grp_codes, nroi), categories=grp_cats
+            ),
+            "roi": pd.Categorical.from_codes(
+                np.repeat(np.arange(nroi), nfm), categories=rois
+            ),
+            "raw": dat.T.reshape(-1),
+        }
+    ).sort_values(["roi", "signal", "Time (s)"], kind="stable")
+    if max_pts is not None:
+        t, y = dat_long["Time (s)"].to_numpy(), dat_long["raw"].to_numpy()
+        keep = [
+            idx[decimate(t[idx], y[idx], max_pts, window=default_window)]
+            for idx in dat_long.groupby(
+                ["roi", "signal"], observed=True, sort=False
+            ).indices.values()
+        ]
+        dat_long = dat_long.iloc[np.sort(np.concatenate(keep))]
     fig = px.line(
         dat_long,
         x="Time (s)",
@@ -26,17 +54,36 @@ def plot_signals(data, rois, fps=30, default_window=None, group_dict=None):
         color="signal",
         range_x=default_window,
         facet_col_spacing=0.04,
+        render_mode="webgl",
     )
     fig.update_yaxes(matches=None, showticklabels=True)
     return fig
 
 
+def decimate(t, y, max_pts, window=None, extra=None):
+    # LTTB indices plus every frame inside window, so the default view and
+    # any extra indices keep full resolution
+    idx = lttb(t, y, max_pts)
+    if window is not None:
+        idx = np.union1d(idx, np.flatnonzero((t >= window[0]) & (t <= window[1])))
+    if extra is not None:
+        idx = np.union1d(idx, extra)
+    return idx
+
+
 def plot_events(evt_df, rois, fps=30):
     id_vars = ["fm_evt", "evt_id", "event"]
-    evt_df = (
-        evt_df[id_vars + rois]
-        .drop_duplicates()
-        .melt(id_vars=id_vars, var_name="roi", value_name="fluorescence")
+    evt_df = evt_df[id_vars + rois].drop_duplicates()
+    dat = evt_df[rois].to_numpy()
+    nfm, nroi = dat.shape
+    evt_df = pd.DataFrame(
+        {
+            **{v: np.tile(evt_df[v].to_numpy(), nroi) for v in id_vars},
+            "roi": pd.Categorical.from_codes(
+                np.repeat(np.arange(nroi), nfm), categories=rois
+            ),
+            "fluorescence": dat.T.reshape(-1),
+        }
     )
     evt_df["Time (s)"] = evt_df["fm_evt"] / fps
     fig = px.line(
@@ -123,50 +170,65 @@ def construct_layout(row_crd, col_crd, row_name="", col_name="", **kwargs):
     return fig, layout
 
 
-def plot_peaks(data, rois, fps=30, default_window=None):
+def plot_peaks(data, rois, fps=30, default_window=None, max_pts=3000):
     sigs = data["signal"].unique()
     t0 = data["SystemTimestamp"].min()
     data["t"] = (data["SystemTimestamp"] - t0) / fps
     fig, layout = construct_layout(rois, sigs, "roi", "signal", shared_xaxes=True)
-    for (roi, sig), ly in layout.groupby(["row_label", "col_label"]):
-        dat = data[data["signal"] == sig]
-        pks = dat[dat[roi + "-pks"]]
-        ly = ly.squeeze()
+    sig_groups = {s: data[data["signal"] == s] for s in sigs}
+    traces, rows, cols = [], [], []
+    for ly in layout.itertuples():
+        roi, dat = ly.row_label, sig_groups[ly.col_label]
+        pk_mask = dat[roi + "-pks"].to_numpy()
+        pks = dat[pk_mask]
         if len(dat) > 0:
-            fig.add_trace(
-                go.Scatter(
-                    x=dat["t"],
-                    y=dat[roi],
+            t, y = dat["t"].to_numpy(), dat[roi].to_numpy()
+            # keep the peak frames so the markers sit on the decimated line
+            idx = (
+                decimate(
+                    t, y, max_pts, window=default_window, extra=np.flatnonzero(pk_mask)
+                )
+                if max_pts is not None
+                else slice(None)
+            )
+            cur_traces = [
+                go.Scattergl(
+                    x=t[idx],
+                    y=y[idx],
                     mode="lines",
                     name="signal",
                     legendgroup="signal",
                     line={"color": "#636EFA"},
-                ),
-                row=ly["row"] + 1,
-                col=ly["col"] + 1,
-            )
+                )
+            ]
             if roi + "-freq" in dat.columns:
-                fig.add_trace(
-                    go.Scatter(
-                        x=dat["t"],
-                        y=dat[roi + "-freq"],
+                y = dat[roi + "-freq"].to_numpy()
+                idx = (
+                    decimate(t, y, max_pts, window=default_window)
+                    if max_pts is not None
+                    else slice(None)
+                )
+                cur_traces.append(
+                    go.Scattergl(
+                        x=t[idx],
+                        y=y[idx],
                         mode="lines",
                         name="freq",
                         legendgroup="freq",
                         line={"color": "grey"},
-                    ),
-                    row=ly["row"] + 1,
-                    col=ly["col"] + 1,
+                    )
                 )
-            fig.add_trace(
+            cur_traces.append(
                 go.Scatter(
                     x=pks["t"],
                     y=pks[roi],
                     mode="markers",
                     marker={"size": 8, "color": "#EF553B", "symbol": "cross"},
                     name="peaks",
-                ),
-                row=ly["row"] + 1,
-                col=ly["col"] + 1,
+                )
             )
+            traces.extend(cur_traces)
+            rows.extend([ly.row + 1] * len(cur_traces))
+            cols.extend([ly.col + 1] * len(cur_traces))
+    fig.add_traces(traces, rows=rows, cols=cols)
     return fig
@@ -2,27 +2,29 @@ import warnings
 
 import numpy as np
 import pandas as pd
-from scipy.optimize import curve_fit
+from scipy.optimize import curve_fit, least_squares
 from scipy.signal import find_peaks
-from scipy.stats import zscore
 from sklearn.linear_model import HuberRegressor
 
-from .utilities import exp2
+from .utilities import exp2, exp2_jac, exp2_resid
 
 
-def photobleach_correction(data, baseline_sig, rois=None):
+def photobleach_correction(data, baseline_sig, rois=None, sig_idx=None):
     # auto set rois
     if rois is None:
         rois = list(
             set([r[0] for r in baseline_sig.keys()])
             | set([r[0] for r in baseline_sig.values()])
         )
+    rois = list(rois)
+    if sig_idx is None:
+        sig_idx = data.groupby("signal", sort=False, observed=True).indices
     # making sure signal exists
     base_dict = dict()
     for (roi, sig), (base_roi, base_sig) in baseline_sig.items():
-        if len(data.loc[data["signal"] == sig, roi]) == 0:
+        if sig not in sig_idx:
             continue
-        if len(data.loc[data["signal"] == base_sig, base_roi]) == 0:
+        if base_sig not in sig_idx:
             warnings.warn(
                 "Cannot find signal '{}' in roi '{}', skipping correction for signal '{}' roi '{}'".format(
                     base_sig, base_roi, sig, roi
@@ -30,53 +32,93 @@ def photobleach_correction(data, baseline_sig, rois=None):
             )
             continue
         base_dict[(roi, sig)] = (base_roi, base_sig)
+    cols = {c: data[c].to_numpy() for c in data.columns}
     # fit baseline
-    base_dfs = dict()
+    base_fits = dict()
     for base_roi, base_sig in set(base_dict.values()):
-        if base_sig in base_dfs:
-            base_df = base_dfs[base_sig]
-        else:
-            base_df = data.loc[data["signal"] == base_sig].copy()
-            base_df["signal"] = base_sig + "-fit"
-            base_df[rois] = np.nan
-        dat_fit = data.loc[data["signal"] == base_sig, base_roi]
+        dat_fit = cols[base_roi][sig_idx[base_sig]]
         x = np.linspace(0, 1, len(dat_fit))
-        base_fit = fit_exp2(dat_fit, x)
-        base_df[base_roi] = base_fit
-        base_dfs[base_sig] = base_df
+        base_fits[(base_roi, base_sig)] = fit_exp2(dat_fit, x)
+    parts = []
+    for base_sig in dict.fromkeys(b[1] for b in base_fits):
+        idx = sig_idx[base_sig]
+        fit_arr = np.full((len(idx), len(rois)), np.nan)
+        for (base_roi, bsig), base_fit in base_fits.items():
+            if bsig == base_sig:
+                fit_arr[:, rois.index(base_roi)] = base_fit
+        parts.append((idx, base_sig + "-fit", fit_arr))
     # correct signals
-    sig_dfs = dict()
-    for (roi, sig), (base_roi, base_sig) in base_dict.items():
-        if sig in sig_dfs:
-            sig_df = sig_dfs[sig]
-            norm_df = sig_df.loc[sig_df["signal"] == sig + "-norm"].copy()
-            zs_df = sig_df.loc[sig_df["signal"] == sig + "-norm-zs"].copy()
+    for sig in dict.fromkeys(k[1] for k in base_dict):
+        pairs = [(roi, base) for (roi, s), base in base_dict.items() if s == sig]
+        idx = sig_idx[sig]
+        y = np.column_stack([cols[roi][idx] for roi, _ in pairs]).astype(float)
+        x = np.column_stack([base_fits[base] for _, base in pairs])
+        norm = y - fit_huber(x, y)
+        norm_ctr = norm - norm.mean(axis=0, keepdims=True)
+        zs = norm_ctr / np.sqrt(np.mean(norm_ctr**2, axis=0, keepdims=True))
+        icols = [rois.index(roi) for roi, _ in pairs]
+        for suffix, val in (("-norm", norm), ("-norm-zs", zs)):
+            sig_arr = np.full((len(idx), len(rois)), np.nan)
+            sig_arr[:, icols] = val
+            parts.append((idx, sig + suffix, sig_arr))
+    # fill one output block with the original data followed by each part
+    nrow = len(data) + sum(len(idx) for idx, _, _ in parts)
+    out = dict()
+    for c, v in cols.items():
+        if c == "signal":
+            dtype = object
+        elif c in rois:
+            dtype = np.result_type(v.dtype, np.float64)
         else:
-            norm_df = data.loc[data["signal"] == sig].copy()
-            norm_df["signal"] = sig + "-norm"
-            norm_df[rois] = np.nan
-            zs_df = data.loc[data["signal"] == sig].copy()
-            zs_df["signal"] = sig + "-norm-zs"
-            zs_df[rois] = np.nan
-        dat_sig = data.loc[data["signal"] == sig, roi]
-        baseline = np.array(base_dfs[base_sig][base_roi])
-        model = HuberRegressor()
-        model.fit(baseline.reshape((-1, 1)), dat_sig)
-        norm_df[roi] = dat_sig - model.predict(baseline.reshape((-1, 1)))
-        zs_df[roi] = zscore(norm_df[roi])
-        sig_dfs[sig] = pd.concat([norm_df, zs_df])
-    data_norm = pd.concat(
-        [data] + list(base_dfs.values()) + list(sig_dfs.values()), ignore_index=True
-    )
+            dtype = v.dtype
+        out[c] = np.empty(nrow, dtype=dtype)
+        out[c][: len(data)] = v
+    offset = len(data)
+    for idx, label, arr in parts:
+        sl = slice(offset, offset + len(idx))
+        for c, v in cols.items():
+            if c != "signal" and c not in rois:
+                out[c][sl] = v[idx]
+        out["signal"][sl] = label
+        for j, roi in enumerate(rois):
+            out[roi][sl] = arr[:, j]
+        offset += len(idx)
+    data_norm = pd.DataFrame(out, copy=False)
     return data_norm
 
 
-def fit_exp2(a, x):
-    dmax, dmin = a[:50].median(), a[-50:].median()
+def fit_huber(x, y):
+    # robust linear fit of each column of y against the matching column of x
+    pred = np.empty_like(y, dtype=float)
+    for k in range(y.shape[1]):
+        model = HuberRegressor()
+        model.fit(x[:, [k]], y[:, k])
+        pred[:, k] = model.predict(x[:, [k]])
+    return pred
+
+
+def fit_exp2(a, x, npts=None):
+    a = np.asarray(a, dtype=float)
+    dmax, dmin = np.median(a[:50]), np.median(a[-50:])
     drg = dmax - dmin
     p0 = (drg, -10, drg, 0.1, dmin - drg)
+    # optionally fit on about npts evenly spaced samples to trade accuracy for speed
+    # the default fits the full trace
+    step = max(len(x) // npts, 1) if npts else 1
+    x_sub, a_sub = x[::step], a[::step]
     try:
-        popt, pcov = curve_fit(exp2, x, a, p0=p0, method="trf", ftol=1e-6, maxfev=1e4)
+        res = least_squares(
+            exp2_resid,
+            p0,
+            jac=exp2_jac,
+            args=(x_sub, a_sub),
+            method="trf",
+            ftol=1e-6,
+            max_nfev=10000,
+        )
+        if not res.success:
+            raise RuntimeError(res.message)
+        popt = res.x
     except:
         warnings.warn("Biexponential fit failed")
         popt = p0
@@ -87,42 +129,65 @@ def compute_dff(data, rois, sigs=["415nm", "470nm"]):
     if sigs is not None:
         data = data[data["signal"].isin(sigs)].copy()
     res_ls = []
-    for sig, dat_sig in data.groupby("signal"):
-        dat_fit = dat_sig.copy()
-        dat_dff = dat_sig.copy()
-        dat_fit["signal"] = sig + "-fit"
-        dat_dff["signal"] = sig + "-dff"
+    for sig, dat_sig in data.groupby("signal", observed=True):
+        dat = dat_sig[rois].to_numpy(dtype=float)
+        fit = np.empty_like(dat)
         x = np.linspace(0, 1, len(dat_sig))
-        for roi in rois:
-            dat = dat_sig[roi]
+        for j in range(len(rois)):
+            y = dat[:, j]
             popt, pcov = curve_fit(
                 exp2,
                 x,
-                dat,
-                p0=(1.0, 0, 1.0, 0, dat.mean()),
+                y,
+                p0=(1.0, 0, 1.0, 0, y.mean()),
                 bounds=(
-                    np.array([-np.inf, -np.inf, -np.inf, -np.inf, dat.min()]),
-                    np.array([np.inf, np.inf, np.inf, np.inf, dat.max()]),
+                    np.array([-np.inf, -np.inf, -np.inf, -np.inf, y.min()]),
+                    np.array([np.inf, np.inf, np.inf, np.inf, y.max()]),
                 ),
             )
-            cur_fit = exp2(x, *popt)
-            dat_fit[roi] = cur_fit
-            dat_dff[roi] = 100 * (dat - cur_fit) / cur_fit
-        res_ls.extend([dat_fit, dat_dff])
+            fit[:, j] = exp2(x, *popt)
+        dff = 100 * (dat - fit) / fit
+        res_ls.append(dat_sig.assign(signal=sig + "-fit", **dict(zip(rois, fit.T))))
+        res_ls.append(dat_sig.assign(signal=sig + "-dff", **dict(zip(rois, dff.T))))
     return pd.concat([data] + res_ls, ignore_index=True)
 
 
-def find_pks(data, rois, prominence, freq_wd=None, sigs=None):
-    for sig, dat_sig in data.groupby("signal"):
-        if sigs is not None and sig in sigs:
-            for roi in rois:
-                dat = dat_sig[roi]
-                pks, props = find_peaks(dat, prominence=prominence)
-                pvec = np.zeros_like(dat, dtype=bool)
-                pvec[pks] = 1
-                data.loc[dat_sig.index, roi + "-pks"] = pvec
-                if freq_wd is not None:
-                    dat_sig.loc[dat_sig.index, roi + "-freq"] = (
-                        dat_sig.loc[dat_sig.index, roi + "-pks"].rolling(freq_wd).sum()
-                    )
+def find_pks(data, rois, prominence, freq_wd=None, sigs=None, sig_idx=None):
+    if sig_idx is None:
+        if sigs is None:
+            sub_idx = np.arange(len(data))
+        else:
+            sub_idx = np.flatnonzero(data["signal"].isin(sigs).to_numpy())
+        # only touch rows of the requested signals
+        sub_sig = data["signal"].iloc[sub_idx].to_numpy()
+        sig_idx = {s: sub_idx[sub_sig == s] for s in pd.unique(sub_sig)}
+    if sigs is None:
+        sigs = list(sig_idx.keys())
+    pks = np.zeros((len(data), len(rois)), dtype=bool)
+    freq = np.full((len(data), len(rois)), np.nan)
+    touched = np.zeros(len(data), dtype=bool)
+    vals = data[rois].to_numpy(dtype=float)
+    for sig in sigs:
+        if sig not in sig_idx:
+            continue
+        rows = sig_idx[sig]
+        touched[rows] = True
+        for j, roi in enumerate(rois):
+            pk_idx, props = find_peaks(vals[rows, j], prominence=prominence)
+            pks[rows[pk_idx], j] = True
+            if freq_wd is not None:
+                # rolling count of peaks as a difference of cumulative sums
+                csum = np.concatenate([[0], np.cumsum(pks[rows, j])])
+                freq[rows[freq_wd - 1 :], j] = csum[freq_wd:] - csum[:-freq_wd]
+    # existing columns keep their values outside the rows of the requested signals
+    outs = [("-pks", pks)] + ([("-freq", freq)] if freq_wd is not None else [])
+    for suffix, val in outs:
+        for j, roi in enumerate(rois):
+            col = roi + suffix
+            if col in data.columns:
+                arr = data[col].to_numpy(copy=True)
+                arr[touched] = val[touched, j]
+                data[col] = arr
+            else:
+                data[col] = val[:, j]
     return data
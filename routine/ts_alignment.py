@@ -6,6 +6,35 @@ from scipy.ndimage import label
 
 from .utilities import load_ts
 
+KEY_NAMES = {
+    "fm_behav": "Behavior frames",
+    "ts_fp": "FP timestamps",
+    "ts": "computer timestamps",
+}
+KEY_DTYPES = {
+    "fm_fp": "int64",
+    "fm_behav": "int64",
+    "ts_fp": "float64",
+    "ts": "float64",
+}
+
+
+def cast_keys(df):
+    # give merge keys the dtypes pandas has specialized join paths for
+    for col, dtype in KEY_DTYPES.items():
+        if col in df.columns and df[col].dtype != dtype and df[col].notnull().all():
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def dup_mask(sr):
+    # rows whose value occurs more than once, by neighbour comparison if sorted
+    if not sr.is_monotonic_increasing:
+        return sr.duplicated(keep=False).to_numpy()
+    v = sr.to_numpy()
+    eq = v[1:] == v[:-1]
+    return np.r_[False, eq] | np.r_[eq, False]
+
 
 def align_ts(data, ts_files) -> None:
     data = data.rename(
@@ -15,10 +44,12 @@ def align_ts(data, ts_files) -> None:
             "ComputerTimestamp": "ts",
         }
     )
+    data = cast_keys(data)
     # load input ts
     ts_dict = dict()
     for dname, dat in ts_files.items():
-        dat, ts_type = load_ts(dat.copy())
+        dat, ts_type = load_ts(dat)
+        dat = cast_keys(dat)
         print("Interpreting {} as {}".format(dname, ts_type))
         if ts_type == "ts_behav" or ts_type == "ts_fp":
             if ts_type in ts_dict.keys():
@@ -47,68 +78,67 @@ def align_ts(data, ts_files) -> None:
             ts_behav = pd.merge_asof(
                 ts_behav, data[["fm_fp", "ts"]], on="ts", direction="nearest"
             ).rename(columns={"ts": "ts_behav"})
-            ts_behav_dup = ts_behav[ts_behav["fm_fp"].duplicated(keep=False)]
+            ts_behav_dup = ts_behav[dup_mask(ts_behav["fm_fp"])]
             if len(ts_behav_dup) > 0:
                 warnings.warn(
                     "Multiple Behavior frames mapped to the same FP frame\n"
                     + str(ts_behav_dup)
                 )
-            data = (
-                data.merge(ts_behav, on="fm_fp", how="outer")
-                .sort_values("fm_fp")
-                .reset_index(drop=True)
-            )
+            data = pd.merge_ordered(data, ts_behav, on="fm_fp", how="outer")
         else:
             warnings.warn("No FP TS supplied, cannot align Behavior frames")
-    # align custom events
-    evts = []
-    for dname, dat in ts_dict.items():
-        if "fm_fp" in dat.columns:
-            evts.append(dat[["fm_fp", "event", "event_type"]])
-        elif "fm_behav" in dat.columns:
-            if "fm_behav" not in data.columns:
-                warnings.warn(
-                    "No Behavior frames supplied, cannot align {}".format(dname)
-                )
-                continue
-            dat = dat.merge(data[["fm_fp", "fm_behav"]], on="fm_behav", how="left")
-            evts.append(dat[["fm_fp", "fm_behav", "event", "event_type"]])
-        elif "ts_fp" in dat.columns:
-            if "ts_fp" not in data.columns:
-                warnings.warn(
-                    "No FP timestamps supplied, cannot align {}".format(dname)
-                )
-                continue
-            dat = pd.merge_asof(
-                dat, data[["fm_fp", "ts_fp"]], on="ts_fp", direction="nearest"
+    # align custom events, batching all sources that share a join key
+    batches = {"fm_fp": [], "fm_behav": [], "ts_fp": [], "ts": []}
+    for isrc, (dname, dat) in enumerate(ts_dict.items()):
+        key = next((k for k in batches if k in dat.columns), None)
+        if key is not None and key != "fm_fp" and key not in data.columns:
+            warnings.warn(
+                "No {} supplied, cannot align {}".format(KEY_NAMES[key], dname)
             )
-            evts.append(dat[["fm_fp", "ts_fp", "event", "event_type"]])
-        elif "ts" in dat.columns:
-            if "ts" not in data.columns:
-                warnings.warn(
-                    "No computer timestamps supplied, cannot align {}".format(dname)
+            continue
+        if key is not None:
+            batches[key].append(
+                dat[list(dict.fromkeys([key, "event", "event_type"]))].assign(
+                    _src=isrc, _row=np.arange(len(dat))
                 )
-                continue
-            dat = pd.merge_asof(
-                dat, data[["fm_fp", "ts"]], on="ts", direction="nearest"
             )
-            evts.append(dat[["fm_fp", "ts", "event", "event_type"]])
         print("aligned {}".format(dname))
+    evts = []
+    for key, dats in batches.items():
+        if not dats:
+            continue
+        dat = pd.concat(dats, ignore_index=True)
+        if key == "fm_behav":
+            dat = dat.merge(data[["fm_fp", "fm_behav"]], on="fm_behav", how="left")
+        elif key != "fm_fp":
+            dat = pd.merge_asof(
+                dat.sort_values(key, kind="stable"),
+                data[["fm_fp", key]],
+                on=key,
+                direction="nearest",
+            )
+        evts.append(dat)
     if not len(evts) > 0:
         return data, ts_dict
-    evts = pd.concat(evts, ignore_index=True).sort_values("fm_fp")
-    evts_dup = evts[evts["fm_fp"].duplicated(keep=False)]
-    if len(evts_dup) > 0:
-        warnings.warn("Multiple events mapped to the same FP frame\n" + str(evts_dup))
-    data = (
-        data.merge(evts[["fm_fp", "event", "event_type"]], on="fm_fp", how="outer")
-        .sort_values("fm_fp")
+    # restore the order the sources and their events were given in
+    evts = (
+        pd.concat(evts, ignore_index=True)
+        .sort_values(["_src", "_row"], kind="stable")
+        .drop(columns=["_src", "_row"])
         .reset_index(drop=True)
+        .sort_values("fm_fp")
     )
+    evts_dup = evts[dup_mask(evts["fm_fp"])]
+    if len(evts_dup) > 0:
+        warnings.warn("Multiple events mapped to the same FP frame\n" + str(evts_dup))
+    # identical events on the same frame would only duplicate data rows
+    evts = evts[["fm_fp", "event", "event_type"]].drop_duplicates()
+    data = pd.merge_ordered(data, evts, on="fm_fp", how="outer")
     return data, ts_dict
 
 
 def label_bout(data, name) -> pd.DataFrame:
-    lb, nlb = label(data[name])
+    # label only tests for nonzero, so hand it a compact bool array
+    lb, nlb = label(data[name].to_numpy() != 0)
     data[name + "_label"] = lb
     return data
@@ -1,37 +1,176 @@
+import functools
 import itertools as itt
 
 import numpy as np
 import pandas as pd
 import pandas.api.types as pdt
 
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
 
-def cut_df(df, nrow, sortby="SystemTimestamp"):
-    return df.sort_values(sortby).iloc[:nrow]
+try:
+    from numba import njit, prange
+except ImportError:
+    prange = range
+
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 
 def exp2(x, a, b, c, d, e):
     return a * np.exp(b * x) + c * np.exp(d * x) + e
 
 
+def exp2_resid(p, x, y):
+    return p[0] * np.exp(p[1] * x) + p[2] * np.exp(p[3] * x) + p[4] - y
+
+
+def exp2_jac(p, x, y):
+    jac = np.empty((x.size, 5))
+    jac[:, 0] = np.exp(p[1] * x)
+    jac[:, 1] = p[0] * x * jac[:, 0]
+    jac[:, 2] = np.exp(p[3] * x)
+    jac[:, 3] = p[2] * x * jac[:, 2]
+    jac[:, 4] = 1.0
+    return jac
+
+
+DATA_DTYPES = {
+    "FrameCounter": "int32",
+    "LedState": "int8",
+    "SystemTimestamp": "float64",
+}
+
+
+def read_data(data_file, discard_nfm=None, usecols=None, chunksize=1_000_000, **kwargs):
+    if str(data_file).endswith(".parquet"):
+        data = pd.read_parquet(data_file, columns=usecols)
+        if discard_nfm is not None:
+            keep = data["FrameCounter"].to_numpy() > discard_nfm
+            data = data[keep].reset_index(drop=True)
+    elif pa is not None and discard_nfm is None:
+        # a list usecols becomes pyarrow's include_columns
+        data = pd.read_csv(data_file, engine="pyarrow", usecols=usecols, **kwargs)
+    elif discard_nfm is not None:
+        data = None
+        if pa is not None and not kwargs:
+            try:
+                data = stream_csv(data_file, discard_nfm, usecols)
+            except pa.ArrowInvalid:
+                # values pyarrow cannot convert, leave them to the default parser
+                if hasattr(data_file, "seek"):
+                    data_file.seek(0)
+        if data is None:
+            # drop discarded frames chunk by chunk so they are never held in full
+            chunks = pd.read_csv(
+                data_file, usecols=usecols, chunksize=chunksize, **kwargs
+            )
+            data = pd.concat(
+                [c[c["FrameCounter"] > discard_nfm] for c in chunks], ignore_index=True
+            )
+    else:
+        data = pd.read_csv(data_file, usecols=usecols, **kwargs)
+    # match the column names the default parser gives to unnamed columns
+    data.columns = [
+        c if c else "Unnamed: {}".format(i) for i, c in enumerate(data.columns)
+    ]
+    for col, dtype in DATA_DTYPES.items():
+        if col in data.columns and data[col].notnull().all():
+            data[col] = data[col].astype(dtype)
+    return data
+
+
+def stream_csv(data_file, discard_nfm, usecols=None):
+    # parse block by block with pyarrow, converting only the selected columns and
+    # dropping discarded frames before anything reaches pandas
+    # types are inferred from the first block only, so a signal column holding
+    # only integers at first would fail once decimals appear: read every listed
+    # column but the frame counter and LED state as float64
+    opts = pacsv.ConvertOptions(
+        include_columns=usecols or [],
+        column_types={
+            c: pa.float64()
+            for c in usecols or []
+            if c not in ("FrameCounter", "LedState")
+        },
+    )
+    reader = pacsv.open_csv(data_file, convert_options=opts)
+    batches = []
+    for batch in reader:
+        keep = pc.greater(batch.column("FrameCounter"), discard_nfm)
+        batches.append(batch.filter(keep))
+    return pa.Table.from_batches(batches, schema=reader.schema).to_pandas()
+
+
+def write_data(data, fpath):
+    if str(fpath).endswith(".parquet"):
+        data.to_parquet(fpath, index=False, compression="zstd")
+        return
+    if pa is not None:
+        try:
+            tab = pa.Table.from_pandas(data, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # mixed-type object columns, leave them to pandas
+            pass
+        else:
+            pacsv.write_csv(tab, fpath)
+            return
+    data.to_csv(fpath, index=False)
+
+
 def load_data(data_file, discard_nfm, led_dict, roi_dict):
     if isinstance(data_file, pd.DataFrame):
-        data = data_file
+        data = data_file[data_file["FrameCounter"] > discard_nfm].copy()
     else:
-        data = pd.read_csv(data_file)
-    data = data[data["FrameCounter"] > discard_nfm].copy()
-    data["signal"] = data["LedState"].map(led_dict)
-    nfm = data.groupby("signal").size().min()
-    data = (
-        data.groupby("signal", group_keys=False)
-        .apply(cut_df, nrow=nfm)
-        .reset_index(drop=True)
-        .rename(columns=roi_dict)
-    )
+        cols = ["FrameCounter", "SystemTimestamp", "LedState", "ComputerTimestamp"]
+        cols = cols + list(roi_dict.keys())
+        # an explicit column list lets the parser skip unused columns entirely
+        header = pd.read_csv(data_file, nrows=0).columns
+        usecols = [c for c in header if c in cols]
+        data = read_data(data_file, discard_nfm, usecols=usecols)
+    # look up signal codes by LedState, unmapped states get the NaN code -1
+    sigs = sorted(set(led_dict.values()))
+    led_codes = np.array([sigs.index(v) for v in led_dict.values()] + [-1])
+    led_idx = pd.Index(list(led_dict.keys())).get_indexer(data["LedState"])
+    codes = led_codes[led_idx]
+    data["signal"] = pd.Categorical.from_codes(codes, categories=sigs)
+    # keep the earliest nfm frames of each signal, in file order
+    ts = data["SystemTimestamp"].to_numpy()
+    counts = np.bincount(codes[codes >= 0], minlength=len(sigs))
+    nfm = counts[counts > 0].min()
+    keep = []
+    for code in np.flatnonzero(counts):
+        idx = np.flatnonzero(codes == code)
+        if len(idx) > nfm:
+            idx = idx[np.argpartition(ts[idx], nfm - 1)[:nfm]]
+        keep.append(idx)
+    data = data.iloc[np.sort(np.concatenate(keep))].reset_index(drop=True)
+    data = data.rename(columns=roi_dict)
+    data["signal"] = data["signal"].cat.remove_unused_categories()
     return data
 
 
+@functools.lru_cache(maxsize=256)
+def read_ts(ts_path, mtime, size):
+    # mtime and size are only part of the cache key
+    if ts_path.endswith(".csv"):
+        return pd.read_csv(ts_path, header=None)
+    elif ts_path.endswith(".xlsx"):
+        try:
+            return pd.read_excel(ts_path, header=None, engine="calamine")
+        except (ImportError, ValueError):
+            return pd.read_excel(ts_path, header=None)
+    else:
+        raise NotImplementedError("Unable to read {}".format(ts_path))
+
+
 def load_ts(ts):
-    ts = df_to_numeric(ts)
+    # columns are only ever replaced, so a shallow copy keeps the input intact
+    ts = df_to_numeric(ts.copy(deep=False))
     if len(ts.columns) == 2:
         if pdt.is_object_dtype(ts[0]) and pdt.is_float_dtype(ts[1]):
             ts.columns = ["event", "ts"]
@@ -53,13 +192,7 @@ def load_ts(ts):
             ts = ts.iloc[1:].copy()
         ts = df_to_numeric(ts)
         ts.columns = ["io_name", "io_flag", "io_state", "ts_fp", "ts"]
-        ts["event"] = (
-            ts["io_name"].astype(str)
-            + "-"
-            + ts["io_flag"].astype(str)
-            + "-"
-            + ts["io_state"].astype(str)
-        )
+        ts["event"] = join_str(ts[["io_name", "io_flag", "io_state"]], "-")
         ts["event_type"] = "arduino"
         ts_type = "ts_arduino"
     else:
@@ -67,33 +200,87 @@ def load_ts(ts):
     return ts, ts_type
 
 
+def join_str(df, sep):
+    # element-wise join of the columns as strings, natively when pyarrow is available
+    strs = [
+        df[c] if pdt.is_string_dtype(df[c]) else df[c].astype(str) for c in df.columns
+    ]
+    if pa is None:
+        return functools.reduce(lambda a, b: a + sep + b, strs)
+    arrs = [pa.array(s, type=pa.string()) for s in strs]
+    out = pc.binary_join_element_wise(*arrs, sep).to_pandas()
+    out.index = df.index
+    return out
+
+
 def pool_events(data, evt_range, rois, norm=True):
     assert "event" in data.columns, "Please align event timestamps first!"
-    evt_idx = data[data["event"].notnull()].index
-    data.loc[evt_idx, "event"] = data.loc[evt_idx, "event"].astype(str)
-    data.loc[evt_idx, "evt_id"] = (
-        data.loc[evt_idx, "event"] + "-" + data.loc[evt_idx, "fm_fp"].astype(str)
+    evt_rows = data["event"].notnull().to_numpy()
+    evt_str = data.loc[evt_rows, "event"].astype(str)
+    data.loc[evt_rows, "event"] = evt_str
+    data.loc[evt_rows, "evt_id"] = (
+        evt_str + "-" + data.loc[evt_rows, "fm_fp"].astype(str)
     )
-    max_fm = data["fm_fp"].max()
-    evt_df = []
-    for idx, row in data[data["evt_id"].notnull()].iterrows():
-        fm = row["fm_fp"]
-        fm_range = tuple((np.array(evt_range) + fm).clip(0, max_fm))
-        dat_sub = data[data["fm_fp"].between(*fm_range)].copy()
-        dat_sub["fm_evt"] = dat_sub["fm_fp"] - fm
-        dat_sub["event"] = row["event"]
-        dat_sub["evt_id"] = row["evt_id"]
-        if norm:
-            for roi in rois:
-                mean = dat_sub.loc[dat_sub["fm_evt"] < 0, roi].mean()
-                std = dat_sub.loc[dat_sub["fm_evt"] < 0, roi].std()
-                if std > 0:
-                    dat_sub[roi] = (dat_sub[roi] - mean) / std
-                else:
-                    dat_sub[roi] = 0
-        evt_df.append(dat_sub)
-    evt_df = pd.concat(evt_df, ignore_index=True)
-    return evt_df
+    # windows are contiguous slices of the frame-sorted rows
+    fm_all = data["fm_fp"].to_numpy()
+    order = np.argsort(fm_all, kind="stable")
+    fm_arr = fm_all[order]
+    evt_mask = (data["evt_id"].notnull() & data["fm_fp"].notnull()).to_numpy()
+    evt_fm = fm_all[evt_mask]
+    evt_names = data["event"].to_numpy(dtype=object)[evt_mask]
+    evt_ids = data["evt_id"].to_numpy(dtype=object)[evt_mask]
+    max_fm = np.nanmax(fm_all)
+    lo = np.clip(evt_fm + evt_range[0], 0, max_fm)
+    hi = np.clip(evt_fm + evt_range[1], 0, max_fm)
+    i0 = np.searchsorted(fm_arr, lo, side="left")
+    i1 = np.searchsorted(fm_arr, hi, side="right")
+    nrow = i1 - i0
+    end = np.cumsum(nrow)
+    start = end - nrow
+    evt_rep = np.repeat(np.arange(len(evt_fm)), nrow)
+    pos = np.repeat(i0 - start, nrow) + np.arange(end[-1] if len(end) else 0)
+    take = order[pos]
+    # pooled windows overlap and repeat rows, so keep them narrow
+    fm_evt = (fm_arr[pos] - evt_fm[evt_rep]).astype(np.int32)
+    # every pooled row repeats its event's labels, so store them as categoricals
+    new_cols = {
+        "event": pd.Categorical(evt_names).take(evt_rep),
+        "evt_id": pd.Categorical(evt_ids).take(evt_rep),
+    }
+    if norm:
+        rois = list(rois)
+        vals = data[rois].to_numpy(dtype=np.float32)[take]
+        new_cols.update(zip(rois, zscore_windows(vals, fm_evt, start, end).T))
+    out = {
+        c: new_cols[c] if c in new_cols else data[c].array.take(take)
+        for c in data.columns
+    }
+    out["fm_evt"] = fm_evt
+    return pd.DataFrame(out, copy=False)
+
+
+@njit(cache=True, parallel=True)
+def zscore_windows(vals, fm_evt, start, end):
+    # z-score each [start, end) window by its pre-event baseline, skipping NaN,
+    # accumulating in float64 whatever the dtype of vals
+    out = np.empty_like(vals)
+    for i in prange(len(start)):
+        for j in range(vals.shape[1]):
+            n = 0
+            s = 0.0
+            for k in range(start[i], end[i]):
+                if fm_evt[k] < 0 and not np.isnan(vals[k, j]):
+                    n += 1
+                    s += vals[k, j]
+            mean = s / max(n, 1)
+            ss = 0.0
+            for k in range(start[i], end[i]):
+                if fm_evt[k] < 0 and not np.isnan(vals[k, j]):
+                    ss += (vals[k, j] - mean) ** 2
+            std = np.sqrt(ss / (n - 1)) if n > 1 else 0.0
+            for k in range(start[i], end[i]):
+                out[k, j] = (vals[k, j] - mean) / std if std > 0 else 0.0
+    return out
 
 
 def enumerated_product(*args):
@@ -101,6 +288,33 @@ def enumerated_product(*args):
 
 
 def df_to_numeric(df):
-    for c in df.columns:
-        df[c] = pd.to_numeric(df[c], errors="ignore")
+    # only text columns can need converting
+    for c in df.select_dtypes(include=["object", "string"]).columns:
+        try:
+            df[c] = pd.to_numeric(df[c])
+        except (ValueError, TypeError):
+            pass
     return df
+
+
+@njit(cache=True)
+def lttb(x, y, n_out):
+    # Largest-Triangle-Three-Buckets downsampling, returns indices of kept points
+    n = len(x)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    edges = np.append(edges, n)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        x_avg = x[hi : edges[i + 2]].mean()
+        y_avg = y[hi : edges[i + 2]].mean()
+        area = np.abs(
+            (x[a] - x_avg) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (y_avg - y[a])
+        )
+        a = lo + np.argmax(area)
+        idx[i + 1] = a
+    return idx